@@ -1,6 +1,8 @@
 import os
-from wsgiref.simple_server import make_server as make_wsgi_server
 import configparser
+
+from waitress import create_server
+
 from ankisyncd import settings
 from ankisyncd.sync_app import SyncApp
 
@@ -29,10 +31,13 @@ class SyncAppController:
         return conf
 
     def make_server(self):
-        self.server = make_wsgi_server(
+        # Every user's collection is only ever touched from its own
+        # collection thread, so requests can safely be served concurrently.
+        self.server = create_server(
+            self.sync_server_app_class(self.config),
             host=self.config['host'],
             port=int(self.config['port']),
-            app=self.sync_server_app_class(self.config)
+            threads=int(self.config.get('threads', 16))
         )
 
     def load_config(self):
@@ -41,7 +46,7 @@ class SyncAppController:
         self.config.update(self.get_config_from_os_env())
 
     def run_server(self):
-        self.server.serve_forever()
+        self.server.run()
 
 
 if __name__ == "__main__":
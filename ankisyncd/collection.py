@@ -3,6 +3,7 @@ import anki.storage
 
 import os, errno
 import logging
+import threading
 
 logger = logging.getLogger("ankisyncd.collection")
 
@@ -72,6 +73,14 @@ class CollectionWrapper:
                 self.__col = self._get_collection()
             else:
                 self.__col = self.__create_collection()
+            self._add_sync_indexes(self.__col)
+
+    @staticmethod
+    def _add_sync_indexes(col):
+        """Adds indexes the sync handlers rely on, but Anki doesn't create."""
+
+        # Used by SyncCollectionHandler.removed() to fetch graves by usn and type.
+        col.db.execute("create index if not exists ix_graves_usn_type on graves (usn, type)")
 
     def close(self):
         """Close the collection if opened."""
@@ -93,16 +102,20 @@ class CollectionManager:
     def __init__(self, config):
         self.collections = {}
         self.config = config
+        self._lock = threading.Lock()
 
     def get_collection(self, path, setup_new_collection=None):
         """Gets a CollectionWrapper for the given path."""
 
         path = os.path.realpath(path)
 
-        try:
-            col = self.collections[path]
-        except KeyError:
-            col = self.collections[path] = self.collection_wrapper(self.config, path, setup_new_collection)
+        # Requests are served concurrently, make sure two of them never end up
+        # with separate wrappers for the same collection.
+        with self._lock:
+            try:
+                col = self.collections[path]
+            except KeyError:
+                col = self.collections[path] = self.collection_wrapper(self.config, path, setup_new_collection)
 
         return col
 
@@ -16,9 +16,9 @@ class SimpleSessionManager:
         return self.sessions.get(hkey)
 
     def load_from_skey(self, skey, session_factory=None):
-        for i in self.sessions:
-            if self.sessions[i].skey == skey:
-                return self.sessions[i]
+        for session in list(self.sessions.values()):
+            if session.skey == skey:
+                return session
 
     def save(self, hkey, session):
         self.sessions[hkey] = session
@@ -14,22 +14,25 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import gzip
 import hashlib
 import io
 import json
 import logging
 import os
-import random
 import re
+import secrets
 import string
 import sys
+import threading
 import time
 import unicodedata
 import zipfile
 from configparser import ConfigParser
 from sqlite3 import dbapi2 as sqlite
 
+import orjson
 from webob import Response
 from webob.dec import wsgify
 from webob.exc import *
@@ -46,6 +49,12 @@ from ankisyncd.full_sync import get_full_sync_manager
 
 logger = logging.getLogger("ankisyncd")
 
+# non-numeric suffixes of client versions, like in beta versions of Anki
+_version_suffix_re = re.compile(r'[^0-9.].*$')
+
+# unicode normalization form Anki uses for media file names on this platform
+_media_normalization_form = "NFD" if anki.utils.isMac else "NFC"
+
 
 class SyncCollectionHandler(anki.sync.Syncer):
     operations = ['meta', 'applyChanges', 'start', 'applyGraves', 'chunk', 'applyChunk', 'sanityCheck2', 'finish']
@@ -55,6 +64,7 @@ class SyncCollectionHandler(anki.sync.Syncer):
         anki.sync.Syncer.__init__(self, col)
 
     @staticmethod
+    @functools.lru_cache(maxsize=512)
     def _old_client(cv):
         if not cv:
             return False
@@ -69,7 +79,7 @@ class SyncCollectionHandler(anki.sync.Syncer):
                 note[name] = int(vs[-1])
 
         # convert the version string, ignoring non-numeric suffixes like in beta versions of Anki
-        version_nosuffix = re.sub(r'[^0-9.].*$', '', version)
+        version_nosuffix = _version_suffix_re.sub('', version)
         version_int = [int(x) for x in version_nosuffix.split('.')]
 
         if client == 'ankidesktop':
@@ -140,39 +150,42 @@ class SyncCollectionHandler(anki.sync.Syncer):
     # Syncer.removed() doesn't use self.usnLim() in queries, so we have to
     # replace "usn=-1" by hand
     def removed(self):
-        cards = []
-        notes = []
-        decks = []
-
-        curs = self.col.db.execute(
-            "select oid, type from graves where usn >= ?", self.minUsn)
-
-        for oid, type in curs:
-            if type == REM_CARD:
-                cards.append(oid)
-            elif type == REM_NOTE:
-                notes.append(oid)
-            else:
-                decks.append(oid)
+        db = self.col.db
+        mu = self.minUsn
+
+        # graves (usn, type) is indexed by CollectionWrapper.open()
+        cards = db.list("select oid from graves where usn >= ? and type = ?", mu, REM_CARD)
+        notes = db.list("select oid from graves where usn >= ? and type = ?", mu, REM_NOTE)
+        decks = db.list("select oid from graves where usn >= ? and type not in (?, ?)",
+                        mu, REM_CARD, REM_NOTE)
 
         return dict(cards=cards, notes=notes, decks=decks)
 
+    # Models, decks and deck configs are stored as JSON blobs in the col
+    # table, so there is no way to filter them by usn in SQL.
     def getModels(self):
-        return [m for m in self.col.models.all() if m['usn'] >= self.minUsn]
+        mu = self.minUsn
+        return [m for m in self.col.models.all() if m['usn'] >= mu]
 
     def getDecks(self):
+        mu = self.minUsn
         return [
-            [g for g in self.col.decks.all() if g['usn'] >= self.minUsn],
-            [g for g in self.col.decks.allConf() if g['usn'] >= self.minUsn]
+            [g for g in self.col.decks.all() if g['usn'] >= mu],
+            [g for g in self.col.decks.allConf() if g['usn'] >= mu]
         ]
 
     def getTags(self):
-        return [t for t, usn in self.col.tags.allItems()
-                if usn >= self.minUsn]
+        mu = self.minUsn
+        return [t for t, usn in self.col.tags.allItems() if usn >= mu]
 
 class SyncMediaHandler(anki.sync.MediaSyncer):
     operations = ['begin', 'mediaChanges', 'mediaSanity', 'uploadChanges', 'downloadFiles']
 
+    # sqlite3 caches prepared statements by their text, so using one constant
+    # statement for both added and removed files means it's compiled only once
+    # per connection.
+    _update_media_sql = "INSERT OR REPLACE INTO media VALUES (?,?,?,?)"
+
     def __init__(self, col):
         anki.sync.MediaSyncer.__init__(self, col)
 
@@ -191,14 +204,24 @@ class SyncMediaHandler(anki.sync.MediaSyncer):
         yet ('dirty'), and info on files it has deleted from its own media dir.
         """
 
-        with zipfile.ZipFile(io.BytesIO(data), "r") as z:
-            self._check_zip_data(z)
-            processed_count = self._adopt_media_changes_from_zip(z)
+        # data is either the raw zip or the uploaded file object itself
+        if isinstance(data, bytes):
+            data = io.BytesIO(data)
 
-        # We increment our lastUsn once for each file we processed.
-        # (lastUsn - processed_count) must equal the client's lastUsn.
-        our_last_usn = self.col.media.lastUsn()
-        self.col.media.setLastUsn(our_last_usn + processed_count)
+        with zipfile.ZipFile(data, "r") as z:
+            self._check_zip_data(z)
+            try:
+                processed_count = self._adopt_media_changes_from_zip(z)
+
+                # We increment our lastUsn once for each file we processed.
+                # (lastUsn - processed_count) must equal the client's lastUsn.
+                # setLastUsn() commits, so the media rows and the new lastUsn
+                # are written in a single transaction.
+                our_last_usn = self.col.media.lastUsn()
+                self.col.media.setLastUsn(our_last_usn + processed_count)
+            except Exception:
+                self.col.media.db.rollback()
+                raise
 
         return {
             'data': [processed_count, self.col.media.lastUsn()],
@@ -210,15 +233,23 @@ class SyncMediaHandler(anki.sync.MediaSyncer):
         max_zip_size = 100*1024*1024
         max_meta_file_size = 100000
 
-        meta_file_size = zip_file.getinfo("_meta").file_size
-        sum_file_sizes = sum(info.file_size for info in zip_file.infolist())
+        meta_file_size = None
+        sum_file_sizes = 0
 
-        if meta_file_size > max_meta_file_size:
-            raise ValueError("Zip file's metadata file is larger than %s "
-                             "Bytes." % max_meta_file_size)
-        elif sum_file_sizes > max_zip_size:
-            raise ValueError("Zip file contents are larger than %s Bytes." %
-                             max_zip_size)
+        for info in zip_file.infolist():
+            if info.filename == "_meta":
+                meta_file_size = info.file_size
+                if meta_file_size > max_meta_file_size:
+                    raise ValueError("Zip file's metadata file is larger than %s "
+                                     "Bytes." % max_meta_file_size)
+
+            sum_file_sizes += info.file_size
+            if sum_file_sizes > max_zip_size:
+                raise ValueError("Zip file contents are larger than %s Bytes." %
+                                 max_zip_size)
+
+        if meta_file_size is None:
+            raise KeyError("There is no item named '_meta' in the archive")
 
     def _adopt_media_changes_from_zip(self, zip_file):
         """
@@ -226,6 +257,9 @@ class SyncMediaHandler(anki.sync.MediaSyncer):
         according to the data in zip file zipData.
         """
 
+        media_dir = self.col.media.dir()
+        normalize = self._normalize_filename
+
         # Get meta info first.
         meta = json.loads(zip_file.read("_meta").decode())
 
@@ -233,7 +267,7 @@ class SyncMediaHandler(anki.sync.MediaSyncer):
         media_to_remove = []
         for normname, ordinal in meta:
             if ordinal == '':
-                media_to_remove.append(self._normalize_filename(normname))
+                media_to_remove.append(normalize(normname))
 
         # Add media files that were added on the client.
         media_to_add = []
@@ -241,14 +275,12 @@ class SyncMediaHandler(anki.sync.MediaSyncer):
             if i.filename == "_meta":  # Ignore previously retrieved metadata.
                 continue
 
-            file_data = zip_file.read(i)
-            csum = anki.utils.checksum(file_data)
-            filename = self._normalize_filename(meta[int(i.filename)][0])
-            file_path = os.path.join(self.col.media.dir(), filename)
+            filename = normalize(meta[int(i.filename)][0])
+            file_path = os.path.join(media_dir, filename)
 
-            # Save file to media directory.
-            with open(file_path, 'wb') as f:
-                f.write(file_data)
+            # Save file to media directory, checksumming it on the way.
+            with zip_file.open(i) as src, open(file_path, 'wb') as dst:
+                csum = self._copy_and_checksum(src, dst)
             mtime = self.col.media._mtime(file_path)
 
             media_to_add.append((filename, csum, mtime, 0))
@@ -262,12 +294,28 @@ class SyncMediaHandler(anki.sync.MediaSyncer):
         if media_to_remove:
             self._remove_media_files(media_to_remove)
 
-        if media_to_add:
-            self.col.media.db.executemany(
-                "INSERT OR REPLACE INTO media VALUES (?,?,?,?)", media_to_add)
+        # Removed files stay in the db with a NULL checksum, that's how other
+        # clients learn about the deletion.
+        media_rows = [(f, None, 0, 0) for f in media_to_remove] + media_to_add
+        if media_rows:
+            self.col.media.db.executemany(self._update_media_sql, media_rows)
 
         return processed_count
 
+    @staticmethod
+    def _copy_and_checksum(src, dst, bufsize=65536):
+        """
+        Copies file object src to dst in chunks and returns the SHA1 checksum
+        of the copied data, as anki.utils.checksum() would.
+        """
+
+        h = hashlib.sha1()
+        for buf in iter(lambda: src.read(bufsize), b''):
+            h.update(buf)
+            dst.write(buf)
+
+        return h.hexdigest()
+
     @staticmethod
     def _normalize_filename(filename):
         """
@@ -276,30 +324,20 @@ class SyncMediaHandler(anki.sync.MediaSyncer):
         """
 
         # Normalize name for platform.
-        if anki.utils.isMac:  # global
-            filename = unicodedata.normalize("NFD", filename)
-        else:
-            filename = unicodedata.normalize("NFC", filename)
-
-        return filename
+        return unicodedata.normalize(_media_normalization_form, filename)
 
     def _remove_media_files(self, filenames):
         """
-        Marks all files in list filenames as deleted and removes them from the
-        media directory.
+        Removes all files in list filenames from the media directory. Marking
+        them as deleted in the db is up to the caller.
         """
 
-        # Mark the files as deleted in our db.
-        self.col.media.db.executemany("UPDATE media " +
-                                      "SET csum = NULL " +
-                                      " WHERE fname = ?",
-                                      [(f, ) for f in filenames])
-
         # Remove the files from our media directory if it is present.
         logger.debug('Removing %d files from media dir.' % len(filenames))
+        media_dir = self.col.media.dir()
         for filename in filenames:
             try:
-                os.remove(os.path.join(self.col.media.dir(), filename))
+                os.remove(os.path.join(media_dir, filename))
             except OSError as err:
                 logger.error("Error when removing file '%s' from media dir: "
                               "%s" % (filename, str(err)))
@@ -309,14 +347,22 @@ class SyncMediaHandler(anki.sync.MediaSyncer):
         cnt = 0
         sz = 0
         f = io.BytesIO()
+        media_dir = self.col.media.dir()
 
-        with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        # Media files are mostly already compressed images and audio, higher
+        # levels burn CPU for next to no gain.
+        with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as z:
             for fname in files:
-                z.write(os.path.join(self.col.media.dir(), fname), str(cnt))
-                flist[str(cnt)] = fname
-                sz += os.path.getsize(os.path.join(self.col.media.dir(), fname))
-                if sz > SYNC_ZIP_SIZE or cnt > SYNC_ZIP_COUNT:
+                path = os.path.join(media_dir, fname)
+                size = os.stat(path).st_size
+                # Check the limits before adding the file, but always send at
+                # least one, otherwise a single file larger than SYNC_ZIP_SIZE
+                # could never be downloaded.
+                if cnt >= SYNC_ZIP_COUNT or (cnt and sz + size > SYNC_ZIP_SIZE):
                     break
+                z.write(path, str(cnt))
+                flist[str(cnt)] = fname
+                sz += size
                 cnt += 1
 
             z.writestr("_meta", json.dumps(flist))
@@ -326,23 +372,32 @@ class SyncMediaHandler(anki.sync.MediaSyncer):
     def mediaChanges(self, lastUsn):
         result = []
         usn = self.col.media.lastUsn()
-        fname = csum = None
 
+        # Anki's media table doesn't track a usn per file, so we can't send
+        # only the rows changed since lastUsn; skip the query entirely when
+        # the client is already up to date, though.
         if lastUsn < usn or lastUsn == 0:
-            for fname,mtime,csum, in self.col.media.db.execute("select fname,mtime,csum from media"):
-                result.append([fname, usn, csum])
+            result = [[fname, usn, csum] for fname, csum in
+                      self.col.media.db.execute("select fname, csum from media")]
 
         return {'data': result, 'err': ''}
 
     def mediaSanity(self, local=None):
-        if self.col.media.mediaCount() == local:
-            result = "OK"
-        else:
-            result = "FAILED"
+        # mediaCount() is a plain "select count() from media where csum is
+        # not null" in Anki
+        count = self.col.media.mediaCount()
+        if count == local:
+            return {'data': "OK", 'err': ''}
 
-        return {'data': result, 'err': ''}
+        logger.debug("Media sanity check failed: client has %s files, server has %s",
+                     local, count)
+        return {'data': "FAILED", 'err': ''}
 
 class SyncUserSession:
+    __slots__ = ('skey', 'name', 'path', 'collection_manager', 'setup_new_collection',
+                 'version', 'client_version', 'created', 'collection_handler',
+                 'media_handler')
+
     def __init__(self, name, path, collection_manager, setup_new_collection=None):
         self.skey = self._generate_session_key()
         self.name = name
@@ -355,12 +410,12 @@ class SyncUserSession:
         self.collection_handler = None
         self.media_handler = None
 
-        # make sure the user path exists
-        if not os.path.exists(path):
-            os.mkdir(path)
+        # make sure the user path exists, another request for the same user
+        # might be creating it at the same time
+        os.makedirs(path, exist_ok=True)
 
     def _generate_session_key(self):
-        return anki.utils.checksum(str(random.random()))[:8]
+        return secrets.token_hex(4)
 
     def get_collection_path(self):
         return os.path.realpath(os.path.join(self.path, 'collection.anki2'))
@@ -385,6 +440,46 @@ class SyncUserSession:
         return handler
 
 
+class ZstdDictCodec:
+    """
+    Compresses and decompresses sync payloads with a pre-trained zstd
+    dictionary, which pays off even for the small JSON bodies of most sync
+    requests. Requires the zstandard package.
+
+    Compression contexts can't be shared between threads, so every thread gets
+    its own pair, all of them using the same digested dictionary.
+    """
+
+    encoding = 'zstd-dict'
+
+    def __init__(self, dict_path, level=1):
+        import zstandard
+
+        with open(dict_path, 'rb') as f:
+            self._dict = zstandard.ZstdCompressionDict(f.read())
+        self._dict.precompute_compress(level=level)
+
+        self._zstandard = zstandard
+        self._level = level
+        self._local = threading.local()
+
+    def _contexts(self):
+        try:
+            return self._local.contexts
+        except AttributeError:
+            contexts = self._local.contexts = (
+                self._zstandard.ZstdCompressor(level=self._level, dict_data=self._dict),
+                self._zstandard.ZstdDecompressor(dict_data=self._dict),
+            )
+            return contexts
+
+    def compress(self, data):
+        return self._contexts()[0].compress(data)
+
+    def decompress(self, data):
+        return self._contexts()[1].decompress(data)
+
+
 class SyncApp:
     valid_urls = SyncCollectionHandler.operations + SyncMediaHandler.operations + ['hostKey', 'upload', 'download']
 
@@ -404,6 +499,11 @@ class SyncApp:
         self.full_sync_manager = get_full_sync_manager(config)
         self.collection_manager = get_collection_manager(config)
 
+        if config.get('zstd_dict_path'):
+            self.zstd_codec = ZstdDictCodec(config['zstd_dict_path'])
+        else:
+            self.zstd_codec = None
+
         # make sure the base_url has a trailing slash
         if not self.base_url.endswith('/'):
             self.base_url += '/'
@@ -447,22 +547,72 @@ class SyncApp:
         """Generates a new host key to be used by the given username to identify their session.
         This values is random."""
 
-        import hashlib, time, random, string
-        chars = string.ascii_letters + string.digits
-        val = ':'.join([username, str(int(time.time())), ''.join(random.choice(chars) for x in range(8))]).encode()
-        return hashlib.md5(val).hexdigest()
+        return secrets.token_hex(16)
 
     def create_session(self, username, user_path):
         return SyncUserSession(username, user_path, self.collection_manager, self.setup_new_collection)
 
+    @staticmethod
+    def _dump_json(obj):
+        # Like json.dumps(), non-string dict keys are converted to strings
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    @staticmethod
+    def _accepts_encoding_explicitly(req, encoding):
+        """
+        Returns True if encoding is listed by name in the request's
+        Accept-Encoding header. Unlike acceptable_offers(), wildcards don't
+        count, which matters for encodings only our own clients understand.
+        """
+
+        if 'Accept-Encoding' not in req.headers:
+            return False
+
+        parsed = req.accept_encoding.parsed or ()
+        return any(coding.lower() == encoding and q > 0 for coding, q in parsed)
+
+    @staticmethod
+    def _encode_response(req, result, zstd_codec=None, min_size=1400):
+        """
+        Gzips result if the client accepts it and it doesn't fit into a single
+        packet anyway. Best speed is used, as most of the time is spent on
+        JSON that compresses well even at the lowest level.
+
+        If zstd_codec is given and the client accepts its encoding, it is
+        preferred regardless of the size of result.
+        """
+
+        if isinstance(result, Response):
+            return result
+        if isinstance(result, str):
+            result = result.encode()
+
+        if zstd_codec is not None and SyncApp._accepts_encoding_explicitly(req, zstd_codec.encoding):
+            return Response(body=zstd_codec.compress(result),
+                            content_encoding=zstd_codec.encoding)
+
+        # A missing Accept-Encoding header technically allows any encoding,
+        # but only compress for clients that explicitly ask for it.
+        if (len(result) < min_size or 'Accept-Encoding' not in req.headers
+                or not req.accept_encoding.acceptable_offers(['gzip'])):
+            return result
+
+        return Response(body=gzip.compress(result, compresslevel=1),
+                        content_encoding='gzip')
+
     def _decode_data(self, data, compression=0):
-        if compression:
-            with gzip.GzipFile(mode="rb", fileobj=io.BytesIO(data)) as gz:
-                data = gz.read()
+        # c=2 is our own extension for data compressed with the zstd dictionary
+        if compression == 2:
+            if self.zstd_codec is None:
+                raise HTTPBadRequest("zstd dictionary compression isn't enabled "
+                                     "on this server.")
+            data = self.zstd_codec.decompress(data)
+        elif compression:
+            data = gzip.decompress(data)
 
         try:
-            data = json.loads(data.decode())
-        except (ValueError, UnicodeDecodeError):
+            data = orjson.loads(data)
+        except ValueError:  # includes invalid UTF-8
             data = {'data': data}
 
         return data
@@ -516,10 +666,16 @@ class SyncApp:
             compression = 0
 
         try:
-            data = req.POST['data'].file.read()
-            data = self._decode_data(data, compression)
+            data_file = req.POST['data'].file
         except KeyError:
             data = {}
+        else:
+            if req.path == self.base_media_url + 'uploadChanges' and not compression:
+                # Media uploads can be up to 100 MiB, let the handler read the
+                # zip straight from the uploaded file instead of copying it.
+                data = {'data': data_file}
+            else:
+                data = self._decode_data(data_file.read(), compression)
 
         if req.path.startswith(self.base_url):
             url = req.path[len(self.base_url):]
@@ -529,7 +685,7 @@ class SyncApp:
             if url == 'hostKey':
                 result = self.operation_hostKey(data.get("u"), data.get("p"))
                 if result:
-                    return json.dumps(result)
+                    return self._dump_json(result)
                 else:
                     # TODO: do I have to pass 'null' for the client to receive None?
                     raise HTTPForbidden('null')
@@ -548,7 +704,6 @@ class SyncApp:
                         session.client_version = data['cv']
 
                     self.session_manager.save(hkey, session)
-                    session = self.session_manager.load(hkey, self.create_session)
 
                 thread = session.get_thread()
 
@@ -559,12 +714,12 @@ class SyncApp:
 
                 # If it's a complex data type, we convert it to JSON
                 if type(result) not in (str, bytes, Response):
-                    result = json.dumps(result)
+                    result = self._dump_json(result)
 
                 if url in self.posthooks:
                     thread.execute(self.posthooks[url], [session])
 
-                return result
+                return self._encode_response(req, result, self.zstd_codec)
 
             elif url == 'upload':
                 thread = session.get_thread()
@@ -604,9 +759,13 @@ class SyncApp:
 
             # If it's a complex data type, we convert it to JSON
             if type(result) not in (str, bytes):
-                result = json.dumps(result)
+                result = self._dump_json(result)
 
-            return result
+            # downloadFiles already returns a deflated zip
+            if url == 'downloadFiles':
+                return result
+
+            return self._encode_response(req, result, self.zstd_codec)
 
         return "Anki Sync Server"
 
@@ -179,7 +179,7 @@ class ThreadingCollectionManager(CollectionManager):
         small memory footprint!) """
         while True:
             cur = time.time()
-            for path, thread in self.collections.items():
+            for path, thread in list(self.collections.items()):
                 if thread.running and thread.wrapper.opened() and thread.qempty() and cur - thread.last_timestamp >= self.monitor_inactivity:
                     self.logger.info("Monitor is closing collection on inactive %s", thread)
                     thread.close()
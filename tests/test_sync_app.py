@@ -1,13 +1,25 @@
 # -*- coding: utf-8 -*-
+import gzip
+import json
 import os
 import sqlite3
 import tempfile
 import unittest
 
 from anki.consts import SYNC_VER
+from webob import Request
+from webob.exc import HTTPBadRequest
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import helpers.server_utils
+from ankisyncd.sync_app import SyncApp
 from ankisyncd.sync_app import SyncCollectionHandler
 from ankisyncd.sync_app import SyncUserSession
+from ankisyncd.sync_app import ZstdDictCodec
 
 from collection_test_base import CollectionTestBase
 
@@ -66,4 +78,89 @@ class SyncCollectionHandlerTest(CollectionTestBase):
 
 
 class SyncAppTest(unittest.TestCase):
-    pass
+    def test_encode_response(self):
+        body = b'{"data": [' + b'1, ' * 1000 + b'1]}'
+        gzip_req = Request.blank('/', headers={'Accept-Encoding': 'gzip, deflate'})
+
+        res = SyncApp._encode_response(gzip_req, body)
+        self.assertEqual(res.content_encoding, 'gzip')
+        self.assertEqual(gzip.decompress(res.body), body)
+
+        # Only compress for clients asking for it, and only if it's worth it.
+        self.assertEqual(SyncApp._encode_response(Request.blank('/'), body), body)
+        self.assertEqual(SyncApp._encode_response(gzip_req, b'{}'), b'{}')
+
+
+@unittest.skipIf(zstandard is None, "zstandard is not installed")
+class ZstdDictCompressionTest(unittest.TestCase):
+    def setUp(self):
+        # Train a small dictionary on payloads resembling sync requests.
+        samples = [json.dumps({
+            'minUsn': i,
+            'lnewer': bool(i % 2),
+            'graves': {'cards': list(range(i % 7)), 'notes': [], 'decks': []},
+        }).encode() for i in range(1000)]
+        zdict = zstandard.train_dictionary(2048, samples)
+
+        fd, self.dict_path = tempfile.mkstemp(suffix=".zdict")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(zdict.as_bytes())
+
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        self.ini_file_path = os.path.join(script_dir, "assets", "test.conf")
+        self.server_app = None
+
+        self.payload = json.dumps({
+            'minUsn': 1234,
+            'lnewer': True,
+            'graves': {'cards': [1, 2, 3], 'notes': [], 'decks': []},
+        }).encode()
+
+    def tearDown(self):
+        if self.server_app is not None:
+            self.server_app.collection_manager.shutdown()
+            self.server_app = None
+        os.unlink(self.dict_path)
+
+    def create_sync_app(self, zstd_dict_path=None):
+        server_paths = helpers.server_utils.create_server_paths()
+        if zstd_dict_path is not None:
+            server_paths['zstd_dict_path'] = zstd_dict_path
+        self.server_app = helpers.server_utils.create_sync_app(server_paths,
+                                                               self.ini_file_path)
+        return self.server_app
+
+    def test_codec_round_trip(self):
+        codec = ZstdDictCodec(self.dict_path)
+        compressed = codec.compress(self.payload)
+        self.assertEqual(codec.decompress(compressed), self.payload)
+
+        # The trained dictionary is required to decompress the data.
+        with self.assertRaises(zstandard.ZstdError):
+            zstandard.ZstdDecompressor().decompress(compressed)
+
+    def test_decode_data(self):
+        app = self.create_sync_app(self.dict_path)
+        data = app.zstd_codec.compress(self.payload)
+        self.assertEqual(app._decode_data(data, compression=2),
+                         json.loads(self.payload.decode()))
+
+    def test_decode_data_without_dict(self):
+        app = self.create_sync_app()
+        self.assertIsNone(app.zstd_codec)
+        with self.assertRaises(HTTPBadRequest):
+            app._decode_data(self.payload, compression=2)
+
+    def test_encode_response(self):
+        codec = ZstdDictCodec(self.dict_path)
+
+        req = Request.blank('/', headers={'Accept-Encoding': 'gzip, zstd-dict'})
+        res = SyncApp._encode_response(req, self.payload, codec)
+        self.assertEqual(res.content_encoding, 'zstd-dict')
+        self.assertEqual(codec.decompress(res.body), self.payload)
+
+        # Wildcards and refusals must not select our private encoding.
+        for accept in ('*', 'zstd-dict;q=0'):
+            req = Request.blank('/', headers={'Accept-Encoding': accept})
+            res = SyncApp._encode_response(req, self.payload, codec)
+            self.assertEqual(res, self.payload)
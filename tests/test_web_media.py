@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 import tempfile
 import filecmp
+import io
+import json
 import sqlite3
 import os
 import shutil
+import zipfile
+from unittest import mock
 
 import helpers.file_utils
 import helpers.server_utils
@@ -355,3 +359,39 @@ class SyncAppFunctionalMediaTest(SyncAppFunctionalTestBase):
             dbpath
         ))
         os.unlink(dbpath)
+
+    def test_download_files_respects_zip_limits(self):
+        """
+        downloadFiles() should never put more than SYNC_ZIP_COUNT files or
+        more than SYNC_ZIP_SIZE bytes into a zip, but should still send a
+        single file exceeding SYNC_ZIP_SIZE on its own.
+        """
+        server = helpers.server_utils.get_syncer_for_hkey(self.server_app,
+                                                      self.hkey,
+                                                      'media')
+
+        fnames = []
+        for i in range(5):
+            fname = "file%d.txt" % i
+            with open(os.path.join(server.col.media.dir(), fname), 'wb') as f:
+                f.write(b'x' * 100)
+            fnames.append(fname)
+
+        def zip_contents(data):
+            with zipfile.ZipFile(io.BytesIO(data)) as z:
+                flist = json.loads(z.read("_meta").decode())
+                size = sum(z.getinfo(name).file_size for name in flist)
+            return flist, size
+
+        with mock.patch('ankisyncd.sync_app.SYNC_ZIP_COUNT', 3):
+            flist, size = zip_contents(server.downloadFiles(fnames))
+        self.assertEqual(sorted(flist.values()), fnames[:3])
+
+        with mock.patch('ankisyncd.sync_app.SYNC_ZIP_SIZE', 250):
+            flist, size = zip_contents(server.downloadFiles(fnames))
+        self.assertEqual(sorted(flist.values()), fnames[:2])
+        self.assertLessEqual(size, 250)
+
+        with mock.patch('ankisyncd.sync_app.SYNC_ZIP_SIZE', 50):
+            flist, size = zip_contents(server.downloadFiles(fnames))
+        self.assertEqual(flist, {'0': fnames[0]})